@@ -1,5 +1,3 @@
-from types import MethodType
-
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -17,56 +15,150 @@ from models.base import (
 )
 
 
-def ball_forward(self, x):
+class BallLinear(nn.Linear):
 
-    w = F.normalize(self.weight, p=2, dim=-1)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
-    return F.linear(x, w, None)
+        # normalized weight, reused while the weight is unchanged
+        self._w_norm_cache = None
+        self._w_version = -1
 
 
-def layer_forward(self, x):
-    return F.layer_norm(x, self.normalized_shape, eps=self.eps)
+    @classmethod
+    def from_linear(cls, linear):
+        # build on meta so no new storage is allocated, then take the old parameters
+        out = cls(
+            linear.in_features, linear.out_features,
+            bias=(linear.bias is not None), device="meta"
+        )
+        out.weight = linear.weight
+        out.bias = linear.bias
 
+        return out
 
-def emb_forward(self, x):
-    out = nn.Embedding.forward(self, x)
 
-    return F.normalize(out, p=2, dim=-1) * (out.shape[-1]**0.5)
+    def _apply(self, *args, **kwargs):
+        # device/dtype moves replace the weight storage
+        self._w_norm_cache = None
+        self._w_version = -1
 
+        return super()._apply(*args, **kwargs)
 
-class BallLmModel(BaseLmModel):
 
-    def post_init(self):
+    def get_normalized_weight(self):
 
-        # handle most things
-        PreTrainedModel.post_init(self)
+        # the cache holds no graph, so it can only be used without gradients
+        if torch.is_grad_enabled():
+            return F.normalize(self.weight, p=2, dim=-1)
+
+        # in-place updates (optimizer steps, load_state_dict) bump the version
+        if self._w_norm_cache is None or self.weight._version != self._w_version:
+            self._w_norm_cache = F.normalize(self.weight, p=2, dim=-1)
+            self._w_version = self.weight._version
+
+        return self._w_norm_cache
+
+
+    def forward(self, x):
+
+        w = self.get_normalized_weight()
+
+        return F.linear(x, w, None)
+
+
+class XLALinear(nn.Linear):
+
+    @classmethod
+    def from_linear(cls, linear):
+        out = cls(
+            linear.in_features, linear.out_features,
+            bias=(linear.bias is not None), device="meta"
+        )
+        out.weight = linear.weight
+        out.bias = linear.bias
+
+        out.no_sim_score = linear.no_sim_score
+
+        return out
+
+
+    def forward(self, x):
+        return _xla_patched_nn_linear_forward(self, x)
+
+
+class BallLayerNorm(nn.LayerNorm):
+
+    @classmethod
+    def from_layer_norm(cls, norm):
+        out = cls(
+            norm.normalized_shape, eps=norm.eps,
+            elementwise_affine=norm.elementwise_affine, device="meta"
+        )
+        out.weight = norm.weight
+        out.bias = norm.bias
 
-        for m in self.modules():
-            if not isinstance(m, nn.Linear):
-                continue
+        return out
 
-            if hasattr(m, "no_sim_score"):
-                if constants.XLA_AVAILABLE:
-                    forward_method = MethodType(_xla_patched_nn_linear_forward, m)
-                    setattr(m, "forward", forward_method)
-            
-            else:
-                forward_method = MethodType(ball_forward, m)
-                setattr(m, "forward", forward_method)
 
-                m.sim_score = None
-                m.sim_count = None
+    def forward(self, x):
+        # no affine params are applied, so this is already one native_layer_norm
+        return F.layer_norm(x, self.normalized_shape, None, None, self.eps)
 
-        for m in self.modules():
-            if not isinstance(m, nn.LayerNorm):
-                continue
 
-            forward_method = MethodType(layer_forward, m)
-            setattr(m, "forward", forward_method)
+class BallEmbedding(nn.Embedding):
+
+    @classmethod
+    def from_embedding(cls, emb):
+        out = cls(
+            emb.num_embeddings, emb.embedding_dim,
+            padding_idx=emb.padding_idx, device="meta"
+        )
+        out.weight = emb.weight
+
+        return out
+
+
+    def forward(self, x):
+        out = super().forward(x)
+
+        return F.normalize(out, p=2, dim=-1) * (out.shape[-1]**0.5)
+
+
+def _convert_linear(linear):
+    if hasattr(linear, "no_sim_score"):
+        return XLALinear.from_linear(linear) if constants.XLA_AVAILABLE else None
+
+    return BallLinear.from_linear(linear)
+
+
+# exact types only, so already converted modules are skipped
+BALL_CONVERTERS = {
+    nn.Linear: _convert_linear,
+    nn.LayerNorm: BallLayerNorm.from_layer_norm,
+    nn.Embedding: BallEmbedding.from_embedding,
+}
+
+
+class BallLmModel(BaseLmModel):
+
+    # lm_head normalizes its weight, so it is not a plain projection
+    supports_fused_lm_head = False
+
+
+    def post_init(self):
+
+        # handle most things
+        PreTrainedModel.post_init(self)
+
+        # swap in ball modules in a single pass, keeping the initialized parameters
+        for m in list(self.modules()):
+            for name, c in m.named_children():
 
-        for m in self.modules():
-            if not isinstance(m, nn.Embedding):
-                continue
+                converter = BALL_CONVERTERS.get(type(c))
+                if converter is None:
+                    continue
 
-            forward_method = MethodType(emb_forward, m)
-            setattr(m, "forward", forward_method)
\ No newline at end of file
+                new = converter(c)
+                if new is not None:
+                    setattr(m, name, new)
@@ -43,6 +43,10 @@ def sim_forward(self, x):
 
 class SimLmModel(BaseLmModel):
 
+    # linear forwards are patched per instance
+    supports_fused_lm_head = False
+
+
     def post_init(self):
 
         # handle most things
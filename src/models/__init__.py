@@ -1,5 +1,7 @@
 """ Models """
 
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 
 import huggingface_hub as hf
@@ -24,21 +26,36 @@ MODEL_DICT = {
 def load_model(model_type, project, name, checkpoint):
     config_obj, model_obj = CONFIG_DICT[model_type], MODEL_DICT[model_type]
 
-    config = config_obj.from_pretrained(
-        f"aklein4/{project}_{name}",
-        subfolder=f"{checkpoint:012d}",
-    )
+    repo = f"aklein4/{project}_{name}"
+    subfolder = f"{checkpoint:012d}"
+
+    # config and checkpoint are independent downloads, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        config_future = ex.submit(
+            config_obj.from_pretrained,
+            repo,
+            subfolder=subfolder,
+        )
+        checkpoint_future = ex.submit(
+            hf.hf_hub_download,
+            repo,
+            subfolder=subfolder,
+            filename="checkpoint.ckpt",
+            local_dir=constants.LOCAL_DATA_PATH
+        )
+
+        config = config_future.result()
+        checkpoint_path = checkpoint_future.result()
 
     model = model_obj(config)
 
-    checkpoint_path = hf.hf_hub_download(
-        f"aklein4/{project}_{name}",
-        subfolder=f"{checkpoint:012d}",
-        filename="checkpoint.ckpt",
-        local_dir=constants.LOCAL_DATA_PATH
-    )
-
-    state_dict = torch.load(checkpoint_path)["model"]
+    # mmap so tensors are paged in from disk instead of unpickled into RAM
+    state_dict = torch.load(
+        checkpoint_path,
+        map_location="cpu",
+        mmap=True,
+        weights_only=True
+    )["model"]
     model.load_state_dict(state_dict, strict=True)
 
     return model
\ No newline at end of file
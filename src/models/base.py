@@ -185,6 +185,11 @@ class BaseTransformer(nn.Module):
 
 class BaseLmModel(XLAModel):
 
+    # forward(return_hidden=True) returns the exact input to a plain linear lm_head,
+    # so trainers may fuse lm_head into the loss
+    supports_fused_lm_head = True
+
+
     def _init_weights(self, module):
 
         if isinstance(module, (nn.Linear)):
@@ -262,6 +267,7 @@ class BaseLmModel(XLAModel):
         segment_ids: Optional[torch.LongTensor]=None,
         position_ids: Optional[torch.LongTensor]=None,
         kv: Optional[Cache]=None,
+        return_hidden: Optional[bool]=False,
     ):
         if self.ignore_segment_ids:
             segment_ids = None
@@ -280,10 +286,16 @@ class BaseLmModel(XLAModel):
         if constants.XLA_AVAILABLE:
             out = out.to(torch.bfloat16)
 
-        lm_logits = self.lm_head(out)
-        lm_logits = F.log_softmax(lm_logits, dim=-1)
+        # let the caller apply lm_head (e.g. fused with the loss)
+        if return_hidden:
+            return out
+
+        return self.get_logits(out)
+
 
-        return lm_logits
+    def get_logits(self, hidden_states):
+        # raw logits, normalization is left to the loss
+        return self.lm_head(hidden_states)
     
 
     def set_training_step(self, step):
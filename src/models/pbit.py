@@ -108,6 +108,10 @@ class PBitLinear(nn.Module):
 
 class PBitLmModel(BaseLmModel):
 
+    # lm_head is a noisy PBitLinear whose forward also feeds get_density()
+    supports_fused_lm_head = False
+
+
     def post_init(self):
 
         # mlp out is only thing that needs to be modified
@@ -3,6 +3,7 @@ import torch
 from transformers import AutoTokenizer
 
 from models import load_model
+from utils.data_utils import cached_tokenize
 import utils.constants as constants
 
 
@@ -26,12 +27,13 @@ def main():
     model = load_model('base', PROJECT, NAME, CHECKPOINT)
     print("Running...\n")
 
-    x = tokenizer(
+    x = cached_tokenize(
+        tokenizer,
         [
             """D&D departs from traditional wargaming by allowing each player to create their own character to play instead of a military formation. These characters embark upon imaginary adventures within a fantasy setting. A Dungeon Master guides the story and the players interact with the setting. Together, they solve dilemmas, engage in battles, and gather treasure and knowledge. In the process, the characters earn experience points in order to rise in levels, and become increasingly powerful over a series of sessions.""",
         ],
-        return_tensors="pt", padding=True
-    ).input_ids
+        padding=True
+    )
 
     out = model(x)
 
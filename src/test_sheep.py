@@ -4,6 +4,7 @@ from transformers import AutoTokenizer
 
 from models.sheep import SheepConfig, SheepLmModel
 from utils.config_utils import load_model_config
+from utils.data_utils import cached_tokenize
 import utils.constants as constants
 
 
@@ -20,7 +21,7 @@ def main():
     assert tokenizer.bos_token_id == constants.GPT2_BOS_TOKEN
     assert tokenizer.eos_token_id == constants.GPT2_EOS_TOKEN
 
-    x = tokenizer(["Hello, my dog is cute", "His dog is cute too", "All dogs are cute"], return_tensors="pt", padding="max_length", max_length=16).input_ids
+    x = cached_tokenize(tokenizer, ["Hello, my dog is cute", "His dog is cute too", "All dogs are cute"], padding="max_length", max_length=16)
     seg_ids = torch.randint_like(x, 4)
 
     print("loading model...")
@@ -6,22 +6,43 @@ import utils.constants as constants
 from trainers.base_xla_trainer import BaseXLATrainer
 from utils.data_utils import DotDict
 from  utils.training_utils import (
-    loss, ppl, acc, pcorr
+    linear_cross_entropy, token_logp, token_loss,
+    token_ppl, token_acc, token_pcorr
 )
 
 
 class XLALmTrainer(BaseXLATrainer):
 
     def train_step(self, step, model, x, seg_ids):
-
-        out = model(x, segment_ids=seg_ids)
         ignore_index = constants.GPT2_PAD_TOKEN
 
+        # cast once up front, so the casts inside the metrics are no-ops
+        x = x.to(torch.int64, non_blocking=True)
+
+        fused = (
+            getattr(model, "supports_fused_lm_head", False) and
+            type(model.lm_head) is nn.Linear and
+            model.lm_head.bias is None
+        )
+
+        if fused:
+            # fuse lm_head into the loss, metrics come from its per-token outputs
+            hidden = model(x, segment_ids=seg_ids, return_hidden=True)
+            lm_loss, logp, correct, valid = linear_cross_entropy(
+                hidden, model.lm_head.weight, x, ignore_index
+            )
+
+        else:
+            # one vocab-wide logsumexp shared by the loss and all metrics
+            out = model(x, segment_ids=seg_ids)
+            logp, correct, valid = token_logp(out, x, ignore_index)
+            lm_loss = token_loss(logp, valid)
+
         results = DotDict(
-            lm_loss=loss(out, x, ignore_index),
-            lm_ppl=ppl(out, x, ignore_index),
-            lm_acc=acc(out, x, ignore_index),
-            lm_pcorr=pcorr(out, x, ignore_index),
+            lm_loss=lm_loss,
+            lm_ppl=token_ppl(logp, valid),
+            lm_acc=token_acc(correct, valid),
+            lm_pcorr=token_pcorr(logp, valid),
         )
         results.loss = results.lm_loss
 
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import torch_xla.core.xla_model as xm
+
 from models.pbit import PBitLinear
 
 from trainers.xla_lm_trainer import XLALmTrainer
@@ -12,8 +14,8 @@ class XLAPBitTrainer(XLALmTrainer):
     def train_step(self, step, model, x, seg_ids):
         results = super().train_step(step, model, x, seg_ids)
 
+        # host-side float, only the loss needs it on device
         w_density = self.w_density * min(1.0, step / self.density_ramp_steps)
-        results.w_density = torch.full_like(results.lm_loss, w_density)
 
         results.density = model.get_density()
         results.density_loss = w_density * results.density
@@ -25,7 +27,12 @@ class XLAPBitTrainer(XLALmTrainer):
             if isinstance(m, PBitLinear):
                 noise_scale = m.noise_scale
         assert noise_scale is not None
-        results.noise_scale = torch.full_like(results.loss, noise_scale)
+
+        # closures run in order, so these land in the log before this step's _post_step
+        def _log_schedule():
+            self.log.w_density = w_density
+            self.log.noise_scale = noise_scale
+
+        xm.add_step_closure(_log_schedule)
 
         return results
-    
\ No newline at end of file
@@ -1,8 +1,13 @@
 import torch
 
 import io
+import os
+import json
+import hashlib
 import numpy as np
 
+import utils.constants as constants
+
 
 def load_byte_array(
     data: bytes
@@ -14,6 +19,40 @@ def load_byte_array(
     return np.lib.format.read_array(stream)
 
 
+def cached_tokenize(
+    tokenizer,
+    text,
+    **kwargs
+) -> torch.LongTensor:
+    """ Tokenize text into input_ids, caching the result on disk.
+        - cache is keyed on the tokenizer, text, and tokenizer kwargs
+        - cached tensors are loaded with mmap, skipping the python tokenizer
+    """
+    key = json.dumps(
+        {
+            "tokenizer": tokenizer.name_or_path,
+            "vocab_size": len(tokenizer),
+            "text": text,
+            "kwargs": kwargs,
+        },
+        sort_keys=True
+    )
+    key = hashlib.blake2b(key.encode()).hexdigest()[:16]
+
+    cache_dir = os.path.join(constants.LOCAL_DATA_PATH, "token_cache")
+    cache_path = os.path.join(cache_dir, f"tok_{key}.pt")
+
+    if os.path.exists(cache_path):
+        return torch.load(cache_path, mmap=True, weights_only=True)
+
+    input_ids = tokenizer(text, return_tensors="pt", **kwargs).input_ids
+
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.save(input_ids, cache_path)
+
+    return input_ids
+
+
 class DotDict(dict):
     """ A dictionary that allows item = d.key access for brevity. """
 
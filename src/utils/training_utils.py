@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, Tuple
 
 import torch
 import torch.nn as nn
@@ -6,7 +6,92 @@ import torch.nn.functional as F
 
 import numpy as np
 
+import utils.constants as constants
 
+
+def _compile_metric(fn):
+    """ Compile a metric into a single static-shape graph.
+     - new shapes recompile, falling back to eager past dynamo's cache limit
+     - skipped on XLA, where metrics are already traced into the step graph
+    """
+    if constants.XLA_AVAILABLE:
+        return fn
+
+    return torch.compile(fn, dynamic=False, fullgraph=True)
+
+
+def _prep(
+    logits: torch.Tensor,
+    x: torch.LongTensor,
+    ignore_index: Optional[int]=-1,
+    shift=True,
+) -> Tuple[torch.Tensor, torch.LongTensor, torch.BoolTensor]:
+    """ Shared setup for the token metrics.
+     - applies offset so that logits_{t} predicts x_{t+1}
+     - casts targets to int64 for gather (no-op if already int64)
+     - builds the mask of non-padding tokens
+
+    Returns:
+        Tuple[torch.Tensor, torch.LongTensor, torch.BoolTensor]: logits [B, T, V], targets [B, T], non-padding mask [B, T]
+    """
+    if shift:
+        x, logits = x[:, 1:], logits[:, :-1]
+    x = x.to(torch.int64)
+
+    return logits, x, x != ignore_index
+
+
+@_compile_metric
+def token_logp(
+    logits: torch.Tensor,
+    x: torch.LongTensor,
+    ignore_index: Optional[int]=-1,
+    shift=True,
+) -> Tuple[torch.Tensor, torch.BoolTensor, torch.BoolTensor]:
+    """ Per-token statistics shared by the loss and metrics.
+     - uses a single logsumexp over the vocab for every metric
+     - uses same data logic as loss()
+
+    Args:
+        logits (torch.Tensor): raw logits from model [B, T, V]
+        x (torch.LongTensor): target tokens [B, T]
+        ignore_index (Optional[int], optional): Paddding token to ignore. Defaults to -1.
+        shift (bool, optional): Whether to shift logits to predict next token. Defaults to True.
+
+    Returns:
+        Tuple[torch.Tensor, torch.BoolTensor, torch.BoolTensor]: target log-probs [B, T] (0 at padding), target-is-max flags [B, T], non-padding mask [B, T]
+    """
+    logits, x, valid = _prep(logits, x, ignore_index, shift)
+
+    # padding may be out of vocab range (e.g. -1), so mask before gathering
+    x = torch.masked_fill(x, ~valid, 0)
+
+    chosen = torch.gather(logits, -1, x.unsqueeze(-1)).squeeze(-1)
+    lse = torch.logsumexp(logits.float(), dim=-1)
+
+    logp = torch.where(valid, chosen.float() - lse, lse.new_zeros(()))
+    correct = torch.logical_and(chosen >= logits.amax(-1), valid)
+
+    return logp, correct, valid
+
+
+def token_loss(
+    logp: torch.Tensor,
+    valid: torch.BoolTensor,
+) -> torch.Tensor:
+    """ Compute cross-entropy loss from per-token target log-probs.
+
+    Args:
+        logp (torch.Tensor): target log-probs, 0 at padding [B, T]
+        valid (torch.BoolTensor): non-padding mask [B, T]
+
+    Returns:
+        torch.Tensor: cross-entropy loss [nats]
+    """
+    return -logp.float().sum() / valid.float().sum()
+
+
+@_compile_metric
 def loss(
     logits: torch.Tensor,
     x: torch.LongTensor,
@@ -26,25 +111,185 @@ def loss(
     Returns:
         torch.Tensor: cross-entropy loss [nats]
     """
+    logits, x, _ = _prep(logits, x, ignore_index, shift)
+
+    # mean is taken over non-padding tokens
+    return F.cross_entropy(
+        logits.reshape(-1, logits.shape[-1]),
+        x.reshape(-1),
+        ignore_index=ignore_index,
+        reduction='mean'
+    ).float()
+
+
+class _LinearCrossEntropy(torch.autograd.Function):
+    """ Chunked lm_head projection + cross-entropy.
+     - only [chunk_size, V] logits are alive at any time
+     - gradients are computed in the forward pass, so no logits are saved for backward
+     - also returns per-token target log-probs and top-1 flags for the metrics
+    """
+
+    @staticmethod
+    def forward(ctx, hidden, weight, x, ignore_index, chunk_size):
+        needs_grad = ctx.needs_input_grad[0] or ctx.needs_input_grad[1]
+
+        logp = []
+        correct = []
+        grad_hidden = []
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32)
+
+        for h, t in zip(
+            torch.split(hidden, chunk_size, dim=0),
+            torch.split(x, chunk_size, dim=0)
+        ):
+            # cast to fp32 inside the chunk, never for the full logits
+            logits = F.linear(h, weight, None).float()
+            lse = torch.logsumexp(logits, dim=-1)
+
+            mask = t == ignore_index
+            t = torch.masked_fill(t, mask, 0)
+
+            chosen = torch.gather(logits, -1, t.unsqueeze(-1)).squeeze(-1)
+            logp.append(torch.masked_fill(chosen - lse, mask, 0.0))
+            correct.append(torch.logical_and(chosen >= logits.amax(-1), ~mask))
+
+            if needs_grad:
+                # d(sum nll)/d(logits) = softmax - onehot
+                g = torch.exp(logits - lse.unsqueeze(-1))
+                g.scatter_add_(-1, t.unsqueeze(-1), -torch.ones_like(chosen).unsqueeze(-1))
+                g = torch.masked_fill(g, mask.unsqueeze(-1), 0.0)
+
+                grad_hidden.append(g.to(hidden.dtype) @ weight)
+                grad_weight.addmm_(g.t(), h.float())
+
+        logp = torch.cat(logp, dim=0)
+        correct = torch.cat(correct, dim=0)
+
+        # keep the token count in fp32, bf16 can't represent counts above 256 exactly
+        count = (x != ignore_index).float().sum()
+
+        if needs_grad:
+            ctx.save_for_backward(
+                (torch.cat(grad_hidden, dim=0).float() / count).to(hidden.dtype),
+                (grad_weight / count).to(weight.dtype)
+            )
+
+        ctx.mark_non_differentiable(logp, correct)
+
+        return -logp.sum() / count, logp, correct
+
+
+    @staticmethod
+    def backward(ctx, grad_output, grad_logp, grad_correct):
+        grad_hidden, grad_weight = ctx.saved_tensors
+
+        return (
+            grad_hidden * grad_output.to(grad_hidden.dtype),
+            grad_weight * grad_output.to(grad_weight.dtype),
+            None, None, None
+        )
+
+
+def linear_cross_entropy(
+    hidden: torch.Tensor,
+    weight: torch.Tensor,
+    x: torch.LongTensor,
+    ignore_index: Optional[int]=-1,
+    shift=True,
+    chunk_size: Optional[int]=1024,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.BoolTensor, torch.BoolTensor]:
+    """ Fused lm_head projection and cross-entropy loss.
+     - equivalent to loss(hidden @ weight.T, x) without materializing [B, T, V] logits
+     - applies offset so that hidden_{t} predicts x_{t+1}
+     - ignores padding tokens
+     - per-token outputs can be passed to token_ppl(), token_acc() and token_pcorr()
+
+    Args:
+        hidden (torch.Tensor): final hidden states from model [B, T, H]
+        weight (torch.Tensor): lm_head weight [V, H]
+        x (torch.LongTensor): target tokens [B, T]
+        ignore_index (Optional[int], optional): Paddding token to ignore. Defaults to -1.
+        shift (bool, optional): Whether to shift hidden states to predict next token. Defaults to True.
+        chunk_size (Optional[int], optional): Number of tokens to project at once. Defaults to 1024.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, torch.BoolTensor, torch.BoolTensor]: cross-entropy loss [nats], target log-probs [B, T], target-is-max flags [B, T], non-padding mask [B, T]
+    """
     if shift:
-        x = x[:, 1:]
-    seq_len = x.shape[-1]
+        x, hidden = x[:, 1:], hidden[:, :-1]
+    x = x.to(torch.int64)
+
+    out, logp, correct = _LinearCrossEntropy.apply(
+        hidden.reshape(-1, hidden.shape[-1]),
+        weight,
+        x.reshape(-1),
+        ignore_index,
+        chunk_size
+    )
+
+    return out, logp.view(*x.shape), correct.view(*x.shape), x != ignore_index
+
+
+@torch.no_grad()
+def token_ppl(
+    logp: torch.Tensor,
+    valid: torch.BoolTensor,
+) -> torch.Tensor:
+    """ Compute perplexity from per-token target log-probs.
+
+    Args:
+        logp (torch.Tensor): target log-probs [B, T]
+        valid (torch.BoolTensor): non-padding mask [B, T]
+
+    Returns:
+        torch.Tensor: Perplexity [nats]
+    """
+    logp = torch.where(valid, logp.float(), logp.new_zeros((), dtype=torch.float32))
+    logp_seq = logp.sum(-1) / valid.float().sum(-1)
+
+    return torch.exp(-logp_seq).mean()
 
-    ar = torch.arange(x.numel(), device=x.device, dtype=x.dtype)
-    ar_bs = ar // seq_len
-    ar_seq = ar % seq_len
-    
-    logp = logits[ar_bs, ar_seq, x.view(-1)].view(*x.shape)
-    loss = -logp.float()
 
-    # mask padding tokens
-    mask = x == ignore_index
-    loss = torch.masked_fill(loss, mask, 0.0)
-    loss = loss.sum() / (~mask).float().sum()
+@torch.no_grad()
+def token_acc(
+    correct: torch.BoolTensor,
+    valid: torch.BoolTensor,
+) -> torch.Tensor:
+    """ Compute top-1 accuracy from per-token target-is-max flags.
+
+    Args:
+        correct (torch.BoolTensor): whether the target reached the max logit [B, T]
+        valid (torch.BoolTensor): non-padding mask [B, T]
+
+    Returns:
+        torch.Tensor: top-1 token accuracy
+    """
+    corr = torch.logical_and(correct, valid).float().sum()
 
-    return loss
+    return corr / valid.float().sum()
 
 
+@torch.no_grad()
+def token_pcorr(
+    logp: torch.Tensor,
+    valid: torch.BoolTensor,
+) -> torch.Tensor:
+    """ Compute token prediction probability from per-token target log-probs.
+
+    Args:
+        logp (torch.Tensor): target log-probs [B, T]
+        valid (torch.BoolTensor): non-padding mask [B, T]
+
+    Returns:
+        torch.Tensor: next-token prediction probability
+    """
+    p = torch.exp(logp.float())
+    p = torch.where(valid, p, p.new_zeros(()))
+
+    return p.sum() / valid.float().sum()
+
+
+@_compile_metric
 @torch.no_grad()
 def ppl(
     logits: torch.Tensor,
@@ -64,24 +309,12 @@ def ppl(
     Returns:
         torch.Tensor: Perplexity [nats]
     """
-    if shift:
-        x = x[:, 1:]
-    seq_len = x.shape[-1]
+    logp, _, valid = token_logp(logits, x, ignore_index, shift)
 
-    ar = torch.arange(x.numel(), device=x.device, dtype=x.dtype)
-    ar_bs = ar // seq_len
-    ar_seq = ar % seq_len
-    
-    logp = logits[ar_bs, ar_seq, x.view(-1)].view(*x.shape).float()
-
-    # mask padding tokens
-    mask = x == ignore_index
-    logp = torch.masked_fill(logp, mask, 0.0)
-    logp_seq = logp.sum(-1) / (~mask).float().sum(-1)
-
-    return torch.exp(-logp_seq).mean()
+    return token_ppl(logp, valid)
 
 
+@_compile_metric
 @torch.no_grad()
 def acc(
     logits: torch.Tensor,
@@ -101,19 +334,12 @@ def acc(
     Returns:
         torch.Tensor: top-1 token accuracy
     """
-    if shift:
-        x, logits = x[:, 1:], logits[:, :-1]
-
-    mask = x == ignore_index
-
-    corr = torch.logical_and(
-        logits.argmax(-1) == x,
-        ~mask
-    ).float().sum()
+    _, correct, valid = token_logp(logits, x, ignore_index, shift)
 
-    return corr / (~mask).float().sum()
+    return token_acc(correct, valid)
 
 
+@_compile_metric
 @torch.no_grad()
 def pcorr(
     logits: torch.Tensor,
@@ -134,18 +360,6 @@ def pcorr(
     Returns:
         torch.Tensor: next-token prediction probability
     """
-    if shift:
-        x = x[:, 1:]
-    seq_len = x.shape[-1]
-
-    ar = torch.arange(x.numel(), device=x.device, dtype=x.dtype)
-    ar_bs = ar // seq_len
-    ar_seq = ar % seq_len
-    
-    logp = logits[ar_bs, ar_seq, x.view(-1)].view(*x.shape).float()
-    p = torch.exp(logp)
+    logp, _, valid = token_logp(logits, x, ignore_index, shift)
 
-    # mask padding tokens
-    mask = x == ignore_index
-    p = torch.masked_fill(p, mask, 0.0)
-    return p.sum() / (~mask).float().sum()
+    return token_pcorr(logp, valid)